@@ -5,137 +5,226 @@ by Travis Wrightsman
 """
 
 import argparse
-from collections import defaultdict, namedtuple
+from collections import defaultdict
 import logging
+import multiprocessing
+import multiprocessing.queues
+import multiprocessing.synchronize
+import os
 from pathlib import Path
-import queue
+import pwd
+import signal
 import sys
 import sqlite3
 import threading
 import time
-from typing import List
-
-import psutil
-
-ShameRecord = namedtuple('ShameRecord', ['timestamp', 'username', 'shame'])
-
-
-def poll_thread_main(poll_queue: queue.Queue, shutdown_event: threading.Event, poll_interval: int,
-                     username_blacklist: List[str], proc_name_blacklist: List[str]):
-    while not shutdown_event.is_set():
-        # poll current processes
-        shame = defaultdict(int)
-        current_timestamp = int(time.time())
-        for proc in psutil.process_iter():
-            if (proc.nice() >= 0) and (proc.username() not in username_blacklist) and (
-                    proc.name() not in proc_name_blacklist):
-                shame[proc.username()] += ((20 - proc.nice()) * proc.cpu_num())
-
-        # add to queue
-        for username in shame:
-            poll_queue.put(ShameRecord(
-                timestamp=current_timestamp,
-                username=username,
-                shame=shame[username]
-            ))
+from typing import AbstractSet, Dict, Iterator, Tuple
+
+# the kernel keeps only this many characters of a process name (TASK_COMM_LEN minus the terminating NUL)
+PROC_NAME_MAX_LENGTH = 15
+
+# kept constant so the write connection's statement cache reuses the prepared statement every tick
+INSERT_SQL = ('INSERT INTO shame(username, shame) VALUES (?, ?) '
+              'ON CONFLICT(username) DO UPDATE SET shame = shame + excluded.shame')
+
+
+def scan_procs(usernames: Dict[int, str]) -> Iterator[Tuple[str, str, int, int]]:
+    # yields (name, username, nice, cpu_num) for each process, reading only /proc/<pid>/stat
+    #
+    # names are the kernel's comm field, so they are cut to PROC_NAME_MAX_LENGTH characters. owners are the uid of
+    # the /proc/<pid> directory rather than the real uid in /proc/<pid>/status, which saves a read per process, but
+    # the kernel reports non-dumpable processes (e.g. setuid programs) as owned by root, so with the default
+    # --ignore-users root they are never shamed
+    with os.scandir('/proc') as entries:
+        for entry in entries:
+            if not entry.name.isdigit():
+                continue
+            try:
+                uid = entry.stat().st_uid
+                fd = os.open('/proc/{}/stat'.format(entry.name), os.O_RDONLY)
+                try:
+                    stat = os.read(fd, 4096)
+                finally:
+                    os.close(fd)
+            except OSError:
+                # the process exited during the scan
+                continue
+
+            # the name can contain spaces and parentheses, so split the fields after the last ')'
+            name_end = stat.rfind(b')')
+            name = stat[stat.find(b'(') + 1:name_end]
+            fields = stat[name_end + 2:].split()
+            username = usernames.get(uid)
+            if username is None:
+                # user added since the cache was loaded, or no passwd entry at all
+                try:
+                    username = pwd.getpwuid(uid).pw_name
+                except KeyError:
+                    username = str(uid)
+                usernames[uid] = username
+            # fields start at stat field 3, so nice (19) and processor (39) are at 16 and 36
+            yield os.fsdecode(name), username, int(fields[16]), int(fields[36])
+
+
+def poll_process_main(poll_queue: multiprocessing.queues.SimpleQueue, shutdown_event: multiprocessing.synchronize.Event,
+                      batch_ready: multiprocessing.synchronize.Event, poll_interval: int, flush_interval: int,
+                      username_blacklist: AbstractSet[str], proc_name_blacklist: AbstractSet[str]):
+    # the parent process handles Ctrl-C and signals shutdown through the event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parent_pid = os.getppid()
+
+    # load the uid to username map once instead of an NSS lookup per process per poll
+    usernames = {user.pw_uid: user.pw_name for user in pwd.getpwall()}
+
+    # buckets are timed on the monotonic clock so wall clock jumps do not stretch or shrink them
+    shame = defaultdict(int)
+    bucket_start = time.monotonic()
+    # stop on our own if the parent dies without signalling shutdown, e.g. on SIGKILL
+    while not shutdown_event.is_set() and os.getppid() == parent_pid:
+        # poll current processes, reading the clock once per tick
+        now = time.monotonic()
+        for name, username, nice, cpu_num in scan_procs(usernames):
+            # most selective filter first
+            if (name not in proc_name_blacklist) and (username not in username_blacklist) and (nice >= 0):
+                shame[username] += ((20 - nice) * cpu_num)
+
+        # add to queue once the bucket spans a full flush interval, then wake the writer
+        if now - bucket_start >= flush_interval:
+            # a bucket is just the per-user shame summed over its polls
+            poll_queue.put(shame)
+            batch_ready.set()
+            shame = defaultdict(int)
+            bucket_start = now
 
         shutdown_event.wait(poll_interval)
 
 
-def write_thread_main(poll_queue: queue.Queue, db_path: str, shutdown_event: threading.Event,
+def write_thread_main(poll_queue: multiprocessing.queues.SimpleQueue, db_con: sqlite3.Connection,
+                      shutdown_event: multiprocessing.synchronize.Event, batch_ready: multiprocessing.synchronize.Event,
                       write_interval: int):
     while not shutdown_event.is_set():
-        # write each item in queue to database
+        # unload queue to write queue, this is the only consumer so empty() cannot be invalidated by another get()
         write_queue = []
         while not poll_queue.empty():
-            # unload queue to write queue
             write_queue.append(poll_queue.get())
+
+        # sum the write queue per user and add it to the running totals
         if write_queue:
-            logging.info("Writing {} items to database".format(len(write_queue)))
-            db_con = sqlite3.connect(db_path)
-            db_cur = db_con.cursor()
-            for record in write_queue:
-                db_cur.execute('INSERT INTO shame VALUES (?, ?, ?)', (record.timestamp, record.username, record.shame))
-            db_con.commit()
-            db_con.close()
+            shame = defaultdict(int)
+            for bucket in write_queue:
+                for username, user_shame in bucket.items():
+                    shame[username] += user_shame
 
-        shutdown_event.wait(write_interval)
+            logging.info("Writing %d items to database", len(shame))
+            with db_con:
+                # one transaction for the whole batch
+                db_con.executemany(INSERT_SQL, shame.items())
 
+        # wake as soon as a bucket is flushed, or after the write interval at the latest
+        if batch_ready.wait(write_interval):
+            batch_ready.clear()
 
-def report_thread_main(leaderboard_path: Path, db_path: str, shutdown_event: threading.Event,
-                       report_interval: int):
+
+def report_thread_main(leaderboard_path: Path, db_con: sqlite3.Connection,
+                       shutdown_event: multiprocessing.synchronize.Event, report_interval: int):
     start_time = time.localtime()
     while not shutdown_event.is_set():
         # query the database
-        db_con = sqlite3.connect(db_path)
         db_cur = db_con.cursor()
-        db_cur.execute('SELECT * FROM shame')
+        db_cur.execute('SELECT username, shame FROM shame ORDER BY shame DESC LIMIT 10')
         rows = db_cur.fetchall()
-
-        column_names = [ele[0] for ele in db_cur.description]
-        username_index = column_names.index('username')
-        shame_index = column_names.index('shame')
         if rows:
-            # build the shame dictionary from the query results
-            shame = defaultdict(int)
-            for row in rows:
-                shame[row[username_index]] += row[shame_index]
-
             # draw the leaderboard
             logging.info('Regenerating the leaderboard')
             current_time = time.localtime()
-            with open(leaderboard_path, 'w') as leaderboard_file:
-                # write the header
-                leaderboard_file.write("Wall of Shame\n")
-                leaderboard_file.write("From {start} to {end}\n\n".format(start=time.asctime(start_time),
-                                                                          end=time.asctime(current_time)))
-                for index, username in enumerate(sorted(shame.keys(), key=lambda item: shame[item], reverse=True)[:10]):
-                    # write the rankings
-                    leaderboard_file.write("[#{rank}] {username} ({shame})\n".format(rank=index + 1,
-                                                                                     username=username,
-                                                                                     shame=shame[username]))
-        db_con.close()
+            # the header
+            lines = ["Wall of Shame\n",
+                     "From {start} to {end}\n\n".format(start=time.asctime(start_time), end=time.asctime(current_time))]
+            # the rankings
+            lines += ["[#{rank}] {username} ({shame})\n".format(rank=index + 1, username=username, shame=shame)
+                      for index, (username, shame) in enumerate(rows)]
+
+            # write in one go to a temporary file and swap it in, so readers never see a partial leaderboard
+            leaderboard_tmp_path = leaderboard_path.with_name(leaderboard_path.name + '.tmp')
+            leaderboard_tmp_path.write_text(''.join(lines))
+            os.replace(leaderboard_tmp_path, leaderboard_path)
 
         shutdown_event.wait(report_interval)
 
 
+def connect_database(db_path: str) -> sqlite3.Connection:
+    db_con = sqlite3.connect(db_path, check_same_thread=False, cached_statements=256)
+    # these settings only last as long as the connection, unlike journal_mode
+    db_con.execute('PRAGMA synchronous=NORMAL')
+    db_con.execute('PRAGMA temp_store=MEMORY')
+    db_con.execute('PRAGMA cache_size=-64000')
+    return db_con
+
+
 def shamed(args):
 
     # initialize the database schema
     db_con = sqlite3.connect(str(args.database))
     db_cur = db_con.cursor()
+    # WAL persists in the database file and lets the report thread read while the write thread inserts
+    db_cur.execute('PRAGMA journal_mode=WAL')
     db_cur.execute('DROP TABLE IF EXISTS shame')
-    db_cur.execute('CREATE TABLE shame(timestamp INT, username TEXT, shame INT)')
+    db_cur.execute('CREATE TABLE shame(username TEXT PRIMARY KEY, shame INT NOT NULL)')
+    # lets the leaderboard query walk the top of the index instead of sorting the table
+    db_cur.execute('CREATE INDEX idx_shame_shame ON shame(shame)')
     db_con.commit()
     db_con.close()
 
-    poll_queue = queue.Queue()
-
-    # start the threads
-    shutdown_event = threading.Event()
-    threads = {
-        'poll': threading.Thread(name='poll', target=poll_thread_main, args=(poll_queue, shutdown_event,
-                                                                             args.poll_interval, args.ignore_users,
-                                                                             args.ignore_names)),
-        'write': threading.Thread(name='write', target=write_thread_main, args=(poll_queue, str(args.database),
-                                                                                shutdown_event, args.write_interval)),
-        'report': threading.Thread(name='report', target=report_thread_main, args=(args.leaderboard, str(args.database),
-                                                                                   shutdown_event,
-                                                                                   args.report_interval))
+    # SimpleQueue.put() writes to the pipe before returning, so a bucket is readable once batch_ready is set
+    poll_queue = multiprocessing.SimpleQueue()
+
+    shutdown_event = multiprocessing.Event()
+    batch_ready = multiprocessing.Event()
+
+    def request_shutdown():
+        shutdown_event.set()
+        # wake the write thread instead of letting it sit out the rest of its interval
+        batch_ready.set()
+
+    # stop the workers on SIGTERM the same way as on Ctrl-C, rather than leaving the poll process behind
+    signal.signal(signal.SIGTERM, lambda signum, frame: request_shutdown())
+
+    # polling runs in its own process so it does not hold the GIL over the other threads, daemon so it never
+    # outlives this process
+    workers = {
+        'poll': multiprocessing.Process(name='poll', target=poll_process_main, daemon=True,
+                                        args=(poll_queue, shutdown_event, batch_ready, args.poll_interval,
+                                              args.write_interval, args.ignore_users, args.ignore_names))
     }
-    logging.debug('Starting threads')
-    for task in threads:
-        threads[task].start()
+    logging.debug('Starting workers')
+    workers['poll'].start()
+
+    # each thread keeps its own connection open for its whole lifetime, opened after the fork so no SQLite
+    # handles are shared with the poll process
+    write_con = connect_database(str(args.database))
+    report_con = connect_database(str(args.database))
+
+    workers['write'] = threading.Thread(name='write', target=write_thread_main, args=(poll_queue, write_con,
+                                                                                      shutdown_event, batch_ready,
+                                                                                      args.write_interval))
+    workers['report'] = threading.Thread(name='report', target=report_thread_main, args=(args.leaderboard,
+                                                                                         report_con, shutdown_event,
+                                                                                         args.report_interval))
+    workers['write'].start()
+    workers['report'].start()
     try:
-        for task in threads:
-            threads[task].join()
+        for task in workers:
+            workers[task].join()
     except KeyboardInterrupt:
         print('Shutting down gracefully')
-        shutdown_event.set()
-        for task in threads:
-            # wait for threads to finish
-            threads[task].join()
-            logging.debug("{} thread successfully shut down".format(task))
+        request_shutdown()
+        for task in workers:
+            # wait for workers to finish
+            workers[task].join()
+            logging.debug("%s worker successfully shut down", task)
+
+    write_con.close()
+    report_con.close()
 
 
 def main():
@@ -215,7 +304,8 @@ def main():
         '--ignore-names',
         dest='ignore_names',
         metavar='"proc_name1, proc_name2, proc_nameN"',
-        help='Comma-separated list of process names to ignore while shaming',
+        help='Comma-separated list of process names to ignore while shaming, matched against the first {} '
+             'characters of the name as kept by the kernel'.format(PROC_NAME_MAX_LENGTH),
         default='bash'
     )
 
@@ -231,8 +321,8 @@ def main():
     if args.report_interval <=0:
         sys.exit('Leaderboard interval must be 1 second or greater.')
 
-    args.ignore_users = [username.strip() for username in args.ignore_users.split(',')]
-    args.ignore_names = [name.strip() for name in args.ignore_names.split(',')]
+    args.ignore_users = frozenset(username.strip() for username in args.ignore_users.split(','))
+    args.ignore_names = frozenset(name.strip() for name in args.ignore_names.split(','))
 
     # set up logging to stderr
     root = logging.getLogger()
@@ -243,6 +333,11 @@ def main():
     stderr_log_handler.setFormatter(stderr_log_formatter)
     root.addHandler(stderr_log_handler)
 
+    for name in sorted(args.ignore_names):
+        if len(name) > PROC_NAME_MAX_LENGTH:
+            logging.warning("Ignored process name '%s' is longer than %d characters and will never match, "
+                            "use '%s' instead", name, PROC_NAME_MAX_LENGTH, name[:PROC_NAME_MAX_LENGTH])
+
     # run the shame daemon
     shamed(args)
 